@@ -1,7 +1,7 @@
 """
 Script to analyse energy consumption data.
 
-Compiled data can be found in compiled_data.csv. The script works by first reading in this data.
+Compiled data can be found in compiled_data.parquet (with a human-readable copy in compiled_data.csv). The script works by first reading in this data.
 
 Running `pip install -r requirements.txt` installs all necessary dependencies for this project.
 
@@ -15,46 +15,73 @@ There are 4 components to the analysis in this script:
 """
 
 ############# IMPORTS AND SET UP ##############################
+import hashlib
 import logging
+import os
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(message)s", datefmt="%d-%b-%y %H:%M:%S"
 )
-logging.info("Importing relevant python packages")
+logging.info(
+    "Importing relevant python packages, plotting and modelling packages are imported in the sections that use them"
+)
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import geopandas as gpd
-import seaborn as sns
-import pymc as pm
-import arviz as az
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import r2_score
 
 RANDOM_SEED = 1999
+# MSOA and LSOA codes aren't used in the analysis, so skip loading them
+ANALYSIS_COLUMNS = [
+    "LA",
+    "temperature",
+    "energy_cost",
+    "net_income",
+    "politically_green",
+    "pct_economically_active",
+    "home_size",
+    "pct_home_occupancy",
+    "home_exposed_surfaces",
+    "home_age",
+    "energy_consumption_per_person",
+]
 
 ############# READ / CLEAN DATASET ############################
 logging.info("Reading in data")
 try:
-    df = pd.read_csv("compiled_data.csv")
+    df = pd.read_parquet("compiled_data.parquet", columns=ANALYSIS_COLUMNS)
     logging.info(f"Compiled dataset read with shape {df.shape}")
 except OSError as e:
     logging.error(f"No file found, try running compile_data.py first. \n{e}")
+    raise SystemExit(1)
 
 
 logging.info("Cleaning up columns with any null values or incorrect dtypes")
-df["politically_green"] = [1 if x == True else 0 for x in df.politically_green]
-df["net_income"] = [int(x.replace(",", "").strip()) for x in df.net_income]
+df["politically_green"] = df["politically_green"].fillna(False).astype(np.int8)
 
 
 ############# PLOTTING ENERGY CONSUMPTION ON A MAP ############
 logging.info("Using geopandas to load and plot energy consumption per capita on a map")
+import matplotlib
+
+matplotlib.use("Agg")  # plots are only saved to file, so skip the GUI backend
+import matplotlib.pyplot as plt
+import geopandas as gpd
+
 logging.info("Read shapefile as a dataframe and tidy up columns")
 las = gpd.GeoDataFrame.from_file("data/LAD_DEC_2021_UK_BFC.shp")
 las.rename(columns={"LAD21CD": "LA"}, inplace=True)
 logging.info("Join shapefile with energy data, averaged by local authority, and plot")
-df_energy = df.groupby("LA")["energy_consumption_per_person"].mean().reset_index()
-las = las.merge(df_energy, on="LA", how="left")
+codes, local_authorities = pd.factorize(df["LA"], sort=False)
+energy = df["energy_consumption_per_person"].to_numpy()
+df_energy = pd.DataFrame(
+    {
+        "LA": local_authorities,
+        "energy_consumption_per_person": np.bincount(codes, weights=energy)
+        / np.bincount(codes),
+    }
+)
+las["energy_consumption_per_person"] = las["LA"].map(
+    df_energy.set_index("LA")["energy_consumption_per_person"]
+)
 las.plot(column="energy_consumption_per_person", cmap="OrRd", edgecolor="k", legend=True)
 plt.title("Domestic energy consumption per person across the UK")
 logging.info("Saving plot to a local .png")
@@ -64,11 +91,19 @@ plt.close()
 
 ############# EXPLORATORY ANALYSIS ############################
 logging.info("\n\nExploratory analysis on dataset")
+import seaborn as sns
+
 logging.info("Plot a correlation heatmap of all the features in the dataset")
 logging.info(
     "Compute correlations of all the feature columns and plot using a seaborn heatmap"
 )
-corr_data = df.drop(columns=["LA", "MSOA", "LSOA"], axis=1).corr()
+# use the rows with complete data, i.e. the same sample as the causal model below
+corr_input = df.drop(columns=["LA"], axis=1).dropna()
+corr_data = pd.DataFrame(
+    np.corrcoef(corr_input.to_numpy(dtype=np.float64), rowvar=False),
+    index=corr_input.columns,
+    columns=corr_input.columns,
+)
 corr_heatmap = sns.heatmap(corr_data, cmap="crest", annot=True)
 corr_heatmap.set_title("Correlations of features related to domestic energy consumption")
 corr_heatmap.set(xlabel="", ylabel="")
@@ -86,6 +121,12 @@ plt.close()
 
 ############# CAUSAL ANALYSIS #################################
 logging.info("\n\nRunning a causal analysis of the data")
+import pymc as pm
+import pytensor
+import arviz as az
+from sklearn.preprocessing import StandardScaler
+from sklearn.metrics import r2_score
+
 model_df = df[
     [
         "LA",
@@ -109,51 +150,38 @@ model_df["net_income"] = model_df["net_income"].astype(float)
 logging.info(
     "Convert Local authority to a categorical code column that we can index into, if needed"
 )
-model_df["LA"] = model_df["LA"].astype("category").cat.codes
+model_df["LA"] = model_df["LA"].cat.codes
 
 logging.info("Normalising continuous variables to z-scores with mean 0 and variance 1")
-scaler = StandardScaler()
-scaler.fit(
-    model_df.iloc[:, 2:]
-)  # don't normalise non-continuous "LA" or "politically_green" features
-model_df.iloc[:, 2:] = scaler.transform(model_df.iloc[:, 2:])
+# don't normalise non-continuous "LA" or "politically_green" features
+continuous = model_df.columns[2:]
+model_df[continuous] = StandardScaler().fit_transform(model_df[continuous].to_numpy())
 logging.info(
     f"Model data prepared, with shape {model_df.shape}. \nAnd features: {model_df.columns[1:-1]}. \nAnd target variable: {model_df.columns[-1]}"
 )
 
+logging.info(
+    "Stacking the features into a single design matrix, in single precision to halve memory traffic"
+)
+features = list(model_df.columns[1:-1])
+X = model_df[features].to_numpy(dtype=np.float32)
+y = model_df.energy_consumption_per_person.to_numpy(dtype=np.float32)
+pytensor.config.floatX = "float32"
+
 logging.info("Defining the probablistic model in pymc")
-with pm.Model() as model:
+with pm.Model(coords={"feature": features}) as model:
 
+    X_data = pm.Data("X", X)
     logging.info("Set uninformative priors for model parameters")
     a = pm.Normal("a", 0, 1)  # a = intercept
-    # b_* parameters are slope parameters in our linear model
-    b_temperature = pm.Normal("b_temperature", 0, 1)
-    b_energy_cost = pm.Normal("b_energy_cost", 0, 1)
-    b_net_income = pm.Normal("b_net_income", 0, 1)
-    b_pct_economically_active = pm.Normal("b_pct_economically_active", 0, 1)
-    b_politically_green = pm.Normal("b_politically_green", 0, 1)
-    b_home_size = pm.Normal("b_home_size", 0, 1)
-    b_pct_home_occupancy = pm.Normal("b_pct_home_occupancy", 0, 1)
-    b_home_exposed_surfaces = pm.Normal("b_home_exposed_surfaces", 0, 1)
-    b_home_age = pm.Normal("b_home_age", 0, 1)
+    # b parameters are slope parameters in our linear model, one per feature
+    b = pm.Normal("b", 0, 1, dims="feature")
     sigma = pm.Exponential("sigma", 1)
 
     logging.info(
         "Define mean energy consumption per person as a linear model of the features"
     )
-    mu = pm.Deterministic(
-        "mu",
-        a
-        + b_politically_green * model_df.politically_green.values
-        + b_temperature * model_df.temperature.values
-        + b_energy_cost * model_df.energy_cost.values
-        + b_net_income * model_df.net_income.values
-        + b_pct_economically_active * model_df.pct_economically_active.values
-        + b_home_size * model_df.home_size.values
-        + b_pct_home_occupancy * model_df.pct_home_occupancy.values
-        + b_home_exposed_surfaces * model_df.home_exposed_surfaces.values
-        + b_home_age * model_df.home_age.values,
-    )
+    mu = a + pm.math.dot(X_data, b)  # not traced, to avoid storing mu for every draw
 
     logging.info(
         "Our likelihood is the based on an assumed normal distribution of energy consumption \nwith its mean defined by a linear model"
@@ -162,28 +190,51 @@ with pm.Model() as model:
         "likelihood",
         mu=mu,
         sigma=sigma,
-        observed=model_df.energy_consumption_per_person.values,
+        observed=y,
     )
 
 logging.info(
     "The posterior is analytically intractable, so we approximate by sampling using MCMC"
 )
 n_samples = 2_000
-logging.info(
-    f"Take {n_samples} samples from the posterior distribution for each model parameter. \nNote that this may take a few minutes to run"
-)
-with model:
-    trace = pm.sample(n_samples, tune=1000, random_seed=RANDOM_SEED)
+n_tune = 1_000
+sampler_settings = {
+    "tune": n_tune,
+    "chains": 4,
+    "random_seed": RANDOM_SEED,
+    "nuts_sampler": "numpyro",  # compile the sampler with JAX rather than pytensor
+    "progressbar": False,
+}
+# the trace is cached on disk, keyed on the model inputs and structure (priors and
+# likelihood), the sampler settings and the pymc version, so any change misses the cache
+inputs_hash = hashlib.sha1(
+    X.tobytes()
+    + y.tobytes()
+    + f"{features},{model.str_repr()},{n_samples},{sorted(sampler_settings.items())},"
+    f"{pm.__version__},{pytensor.config.floatX}".encode()
+).hexdigest()
+trace_file = f"trace_{inputs_hash[:12]}.nc"
+if os.path.exists(trace_file):
+    logging.info(f"Loading cached posterior samples from {trace_file}")
+    trace = az.from_netcdf(trace_file)
+else:
+    logging.info(
+        f"Take {n_samples} samples from the posterior distribution for each model parameter. \nNote that this may take a few minutes to run"
+    )
+    with model:
+        trace = pm.sample(n_samples, **sampler_settings)
+    logging.info(f"Caching posterior samples to {trace_file}")
+    az.to_netcdf(trace, trace_file)
 
 logging.info(
     "Plot the distribution of the regression coefficents and save to a local .png"
 )
 with model:
     az.plot_forest(
-        trace,
+        # split the slope parameters into one variable per feature, so that each ridge
+        # is scaled to its own height rather than all sharing one scale
+        trace.posterior["b"].to_dataset(dim="feature"),
         kind="ridgeplot",
-        filter_vars="regex",
-        var_names=["^b"],  # only include b_* parameters
         hdi_prob=0.99,  # capture the highest density 99% of each param distribution
         textsize=8.0,
         figsize=(5, 3),
@@ -198,12 +249,12 @@ plt.close()
 logging.info(
     "Look at the mean predictions for energy consumption from the model, \nand compute model goodness of fit with R-squared"
 )
-with model:
-    # sample from posterior for energy consumption
-    predictions = pm.sample_posterior_predictive(trace, model, random_seed=RANDOM_SEED)
-# compute the mean for each LSOA
-y_pred = np.mean(predictions["posterior_predictive"].likelihood[0], axis=0)
-y_true = model_df.energy_consumption_per_person.values
+# mu is linear in the coefficients, so its posterior mean comes from the coefficient means
+y_pred = (
+    trace.posterior["a"].mean().values
+    + X @ trace.posterior["b"].mean(dim=("chain", "draw")).values
+)
+y_true = y
 # calculate the R2 score for how well the model explains the data
 score = r2_score(y_true, y_pred)
 logging.info(f"R-squared for model goodness of fit = {round(score,2)}")
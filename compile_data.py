@@ -5,7 +5,7 @@ Raw data can be found in raw_data.zip, extract before running this file. The scr
 
 Run `pip install -r requirements.txt` installs all necessary dependencies for this project.
 
-General approach is to start with the "usmart" energy consumption dataset, and merge in new features from other datasets, joining on either the local area code, MSOA or LSOA. Given we need to join multiple datasets together, it makes sense to work in pandas, and make use of the DataFrame.merge() function!
+General approach is to start with the "usmart" energy consumption dataset, and add in new features from other datasets, joining on either the local area code, MSOA or LSOA. Given we need to join multiple datasets together, it makes sense to work in pandas, and make use of the DataFrame.join() function!
 
 The usmart dataset was released in 2021 - we will try to use datasets that match this assumed effective date / period - handy that there was a UK census in 2021!
 
@@ -37,10 +37,14 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(message)s", datefmt="%d-%b-%y %H:%M:%S"
 )
 logging.info("Importing relevant python packages")
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
-import geopy.distance
 from netCDF4 import Dataset
+from scipy.spatial import cKDTree
 
 
 """
@@ -50,51 +54,225 @@ We need to set a few assumptions on energy prices
 Taken from:
 https://www.icaew.com/insights/viewpoints-on-the-news/2022/sept-2022/chart-of-the-week-energy-price-cap-update
 
-Also set assumption for % of green vote that we define as making an area "green politically"
+Also set assumption for % of green vote that we define as making an area "green politically",
+and assumptions used to estimate how energy-efficient the homes in an area are
 """
 GAS_PRICE_PER_KWH = 3.3
 ELECTRIC_PRICE_PER_KWH = 19.0
 POLITICALLY_GREEN_THRESHOLD = 0.1
 
+# number of 'exposed surfaces' per building type - flats are more energy-efficient for this reason
+exposed_surfaces_per_type = {
+    "bungalow_total": 5,
+    "flat_mais_total": 2,
+    "house_terraced_total": 3,
+    "house_semi_total": 4,
+    "house_detached_total": 5,
+}
+
+# building age is given in bands - estimate a rough mid-point for bands where applicable
+build_dates = {
+    "bp_pre_1900": 1900,
+    "bp_1900_1918": 1910,
+    "bp_1919_1929": 1925,
+    "bp_1930_1939": 1935,
+    "bp_1945_1954": 1950,
+    "bp_1955_1964": 1960,
+    "bp_1965_1972": 1969,
+    "bp_1973_1982": 1978,
+    "bp_1983_1992": 1988,
+    "bp_1993_1999": 1996,
+    "bp_2000_2008": 2004,
+    "bp_2009": 2009,
+    "bp_2010": 2010,
+    "bp_2011": 2011,
+    "bp_2012": 2012,
+    "bp_2013": 2013,
+    "bp_2014": 2014,
+    "bp_2015": 2015,
+    "bp_2016": 2016,
+    "bp_2017": 2017,
+    "bp_2018": 2018,
+    "bp_2019": 2019,
+    "bp_2020": 2020,
+    "bp_2021": 2021,
+    "bp_2022_2023": 2021,
+    "bp_unkw": 1900,  # assume if unknown then likely very old
+}
+build_periods = list(build_dates)
+
+
+def read_csv_cached(path, **kwargs):
+    """
+    Read a csv with pandas, caching the parsed result as a parquet file next to it.
+
+    Later runs read the typed, columnar parquet copy instead of re-parsing the csv. The cache
+    file name includes a hash of the read_csv arguments and of the csv's size and
+    modification time, so any change to the csv (including an older copy extracted from
+    raw_data.zip) misses the cache and the csv is parsed again.
+
+    Parameters
+    ----------
+    path: str
+        path to the csv file
+    **kwargs:
+        passed on to pd.read_csv, e.g. usecols. Must have a stable repr, so no lambdas
+
+    Returns
+    -------
+    data: pd.DataFrame
+        the parsed csv
+    """
+    source = os.stat(path)
+    key = repr((source.st_size, source.st_mtime_ns, sorted(kwargs.items())))
+    cache = f"{os.path.splitext(path)[0]}_{hashlib.sha1(key.encode()).hexdigest()[:12]}"
+    if os.path.exists(f"{cache}.parquet"):
+        logging.info(f"Reading cached copy of {path}")
+        return pd.read_parquet(f"{cache}.parquet", engine="pyarrow")
+    data = pd.read_csv(path, **kwargs)
+    # write to a temporary file first, so an interrupted run can't leave a truncated cache
+    data.to_parquet(f"{cache}.{os.getpid()}.tmp", engine="pyarrow", compression="snappy")
+    os.replace(f"{cache}.{os.getpid()}.tmp", f"{cache}.parquet")
+    return data
+
+
 """
 LOADING THE DATA
 ----------------
-Read in the main dataset
+Start reading every source dataset in the background, then read in the main dataset
 """
+logging.info("\n\nStarting to read all the source datasets in parallel")
+# columns used from the main dataset, and what we rename them to
+main_columns = {
+    "Local Authority Name": "LA_name",
+    "Local Authority Code": "LA",
+    "MSOA Name": "MSOA_name",
+    "Middle Layer Super Output Area (MSOA) Code": "MSOA",
+    "LSOA Name": "LSOA_name",
+    "Lower Layer Super Output Area (LSOA) Code": "LSOA",
+    "Latitude": "Latitude",
+    "Longitude": "Longitude",
+    "Electricity Consumption (kWh)": "elec_consumption",
+    "Total Energy Consumption (kWh)": "total_consumption",
+    "Average Energy Consumption per Person (kWh)": "energy_consumption_per_person",
+}
+
+# the csv / parquet readers release the GIL while parsing, so each source is read on its own
+# thread, while the main thread works through the features below as each read completes.
+# The csvs are parsed with the multi-threaded pyarrow engine where it supports the options
+pool = ThreadPoolExecutor()
+reads = {
+    # only parse the columns we use - the file has a further 10 meter / gas columns
+    "energy": pool.submit(
+        read_csv_cached,
+        "data/LSOA Energy Consumption Data.csv",
+        engine="pyarrow",
+        usecols=list(main_columns),
+        # codes are stored as categoricals, so joins hash integer codes rather than strings
+        dtype={
+            "Local Authority Code": "category",
+            "Middle Layer Super Output Area (MSOA) Code": "category",
+            "Lower Layer Super Output Area (LSOA) Code": "category",
+            "Latitude": np.float64,
+            "Longitude": np.float64,
+        },
+    ),
+    "households": pool.submit(
+        read_csv_cached,
+        "data/RM202-Household-Size-By-Number-Of-Rooms-2021-lsoa-ONS.csv",
+        engine="pyarrow",
+        usecols=[
+            "Lower layer Super Output Areas Code",
+            "Number of rooms (Valuation Office Agency) (6 categories) Code",
+            "Household size (5 categories) Code",
+            "Observation",
+        ],
+        dtype={
+            "Number of rooms (Valuation Office Agency) (6 categories) Code": np.int32,
+            "Household size (5 categories) Code": np.int32,
+            "Observation": np.int32,
+        },
+    ),
+    "building_type": pool.submit(
+        read_csv_cached,
+        "data/CTSOP_3_1_2021.csv",
+        engine="pyarrow",
+        usecols=[
+            "geography",
+            "band",
+            "ecode",
+            "bungalow_total",
+            "flat_mais_total",
+            "house_terraced_total",
+            "house_semi_total",
+            "house_detached_total",
+            "all_properties",
+        ],
+        na_values=["-"],  # counts of zero are recorded as "-"
+    ),
+    # only parse the filter / key columns and the build period counts
+    "building_age": pool.submit(
+        read_csv_cached,
+        "data/CTSOP_4_1_2021.csv",
+        engine="pyarrow",
+        usecols=["geography", "band", "ecode", *build_periods],
+        na_values=["-"],  # counts of zero are recorded as "-"
+    ),
+    "income": pool.submit(
+        read_csv_cached,
+        "data/net_income_after_housing_costs.csv",
+        # the pyarrow engine doesn't support thousands separators, so keep the default here
+        usecols=["MSOA code", "Net annual income after housing costs (£)"],
+        thousands=",",
+    ),
+    "voting": pool.submit(
+        read_csv_cached,
+        "data/CBP09228_detailed_results_England_elections.csv",
+        engine="pyarrow",
+        usecols=["ONS code", "Green", "Total"],
+    ),
+    "economic_activity": pool.submit(
+        read_csv_cached,
+        "data/economic_activity.csv",
+        engine="pyarrow",
+        usecols=[
+            "Area code",
+            "Economically active: \nIn employment \n(including full-time students), \n2021\n(percent)",
+        ],
+    ),
+}
+pool.shutdown(wait=False)
+
 logging.info("\n\nLoading main dataset on energy consumption")
-df = pd.read_csv("data/LSOA Energy Consumption Data.csv")
+df = reads["energy"].result()
 logging.info(f"Data loaded, {len(df)} rows")
 
 logging.info("Tidying up the columns")
-df = df[
-    [
-        "Local Authority Name",
-        "Local Authority Code",
-        "MSOA Name",
-        "Middle Layer Super Output Area (MSOA) Code",
-        "LSOA Name",
-        "Lower Layer Super Output Area (LSOA) Code",
-        "Latitude",
-        "Longitude",
-        "Electricity Consumption (kWh)",
-        "Total Energy Consumption (kWh)",
-        "Average Energy Consumption per Person (kWh)",
-    ]
-].copy()
-
-df.columns = [
-    "LA_name",
-    "LA",
-    "MSOA_name",
-    "MSOA",
-    "LSOA_name",
-    "LSOA",
-    "Latitude",
-    "Longitude",
-    "elec_consumption",
-    "total_consumption",
-    "energy_consumption_per_person",
-]
+df = df.rename(columns=main_columns)
+
+
+def lookup_by_category(keys, lookup):
+    """
+    Look up a value for each row of a categorical key column.
+
+    Each category is looked up once, and the values are broadcast to rows by category code.
+
+    Parameters
+    ----------
+    keys: pd.Series
+        a categorical column of keys, e.g. LA codes
+    lookup: pd.Series
+        values indexed by key
+
+    Returns
+    -------
+    values: np.ndarray
+        the value for each row, NaN where the key isn't in "lookup"
+    """
+    values = lookup.reindex(keys.cat.categories).to_numpy()
+    # missing keys have code -1, which picks up the trailing NaN
+    return np.append(values, np.nan)[keys.cat.codes]
+
 
 """
 COMPILING THE DATASET
@@ -103,7 +281,7 @@ Do this in phases, one dataset at a time.
 
 1. Load in new source
 2. Generate the relevant feature(s)
-3. Merge with main "df" dataset
+3. Add to main "df" dataset - LA / MSOA features are looked up directly, LSOA features are joined in one go at the end
 4. Move onto the next source!
 
 """
@@ -114,57 +292,74 @@ file_name = "data/tas_hadukgrid_uk_60km_ann_202101-202112.nc"
 logging.info(
     "Load temperaure measurement data and extract latitudes, longitudes, temperatures for each measurement"
 )
-climate_data = Dataset(file_name)
-latitude = climate_data.variables["latitude"][:, :]
-longitude = climate_data.variables["longitude"][:, :]
-temps = climate_data.variables["tas"][:, :]
+with Dataset(file_name) as climate_data:
+    latitude = climate_data.variables["latitude"][:, :]
+    longitude = climate_data.variables["longitude"][:, :]
+    temps = climate_data.variables["tas"][0]  # only read the single annual time step
 logging.info(
-    f"Loading each of the {len(temps[0])} temperature observations into a dictionary, removing null values"
+    f"Averaging each of the {len(temps)} temperature observations, removing null values"
 )
-lats = [np.mean(x) for x in latitude]  # take average of temp from each point in grid
-longs = [np.mean(x) for x in longitude]
-ts = [np.mean(x) for x in temps[0]]
-temp_dict = {coord: t for coord, t in zip(list(zip(lats, longs)), ts)}
-temp_dict = {k: v for k, v in temp_dict.items() if v > 0}
+lats = latitude.mean(axis=1)  # take average of temp from each point in grid
+longs = longitude.mean(axis=1)
+ts = temps.mean(axis=1)  # fill values are masked, so rows entirely at sea stay masked
+valid = (ts > 0).filled(False)
+# keep the grid as three parallel, unmasked float64 arrays
+grid_lats = np.ma.getdata(lats)[valid]
+grid_longs = np.ma.getdata(longs)[valid]
+grid_temps = np.ma.getdata(ts)[valid]
 
 
-def find_closest_temp_measurement(this_point):
+def to_unit_vectors(lats, longs):
     """
-    Find the nearest temperature measurement from the dataset.
+    Convert latitudes and longitudes to 3D unit vectors on a sphere.
+
+    Euclidean (chord) distance between unit vectors is monotonic in great-circle distance,
+    so a nearest neighbour search in this space finds the geographically closest point.
 
     Parameters
     ----------
-    this_point: tuple
-        a (latitude, longitude) tuple
+    lats: array-like
+        latitudes in degrees
+    longs: array-like
+        longitudes in degrees
 
     Returns
     -------
-    temperature: float
-        the average temperaure from the nearest temperature measurement to "this_point" in 2021
+    vectors: np.ndarray
+        an (n, 3) array of (x, y, z) unit vectors
     """
-    return temp_dict[
-        min(temp_dict.keys(), key=lambda x: geopy.distance.geodesic(this_point, x))
-    ]
+    lats, longs = np.radians(lats), np.radians(longs)
+    return np.stack(
+        [np.cos(lats) * np.cos(longs), np.cos(lats) * np.sin(longs), np.sin(lats)],
+        axis=-1,
+    )
 
 
 logging.info(
-    "Generating tuples of (lat, long) in the main dataset, finding the nearest temperature measurement by geodetic distance"
+    "Building a KD-tree of temperature measurements, finding the nearest measurement to each LSOA"
+)
+tree = cKDTree(to_unit_vectors(grid_lats, grid_longs))
+lsoa_coords = df[["Latitude", "Longitude"]].to_numpy(dtype=np.float64)
+_, closest = tree.query(
+    to_unit_vectors(lsoa_coords[:, 0], lsoa_coords[:, 1]),
+    k=1,
+    workers=-1,  # split the LSOA queries across all cores
 )
-df["coords"] = [(lat, long) for lat, long in zip(df.Latitude, df.Longitude)]
-df["temperature"] = [find_closest_temp_measurement(x) for x in df.coords]
+df["temperature"] = grid_temps[closest]
 logging.info(f"Check dataset shape: {df.shape}")
 
 ####################### ENERGY COST DATA ###################################
 logging.info(
     "\n\nAdding energy cost data based on the electric vs gas usage of each LSOA"
 )
-df["pct_electric"] = df["elec_consumption"] / df["total_consumption"]
+pct_electric = df["elec_consumption"].to_numpy() / df["total_consumption"].to_numpy()
+df["pct_electric"] = pct_electric
 logging.info(
     f"Compute estimate for relative energy cost by LSOA, assuming gas price of {GAS_PRICE_PER_KWH}p per kwh and electric price of {ELECTRIC_PRICE_PER_KWH}p per kwh"
 )
-df["energy_cost"] = [
-    ELECTRIC_PRICE_PER_KWH * x + GAS_PRICE_PER_KWH * (1 - x) for x in df["pct_electric"]
-]
+df["energy_cost"] = (
+    ELECTRIC_PRICE_PER_KWH * pct_electric + GAS_PRICE_PER_KWH * (1.0 - pct_electric)
+)
 logging.info(f"Check dataset shape: {df.shape}")
 
 ####################### INCOME DATA ########################################
@@ -172,41 +367,40 @@ logging.info(
     "\n\nAdding net income data (post housing costs) per household from ONS, provided by MSOA"
 )
 logging.info("Read in csv and tidy up columns")
-income_data = pd.read_csv("data/net_income_after_housing_costs.csv")
-income_data = income_data[
-    ["MSOA code", "Net annual income after housing costs (£)"]
-].copy()
+income_data = reads["income"].result()
 income_data.columns = ["MSOA", "net_income"]
-logging.info("Merge with main dataset")
-df = df.merge(income_data, on="MSOA", how="left")
+logging.info("Look up net income for each MSOA in main dataset")
+df["net_income"] = pd.array(
+    lookup_by_category(df["MSOA"], income_data.set_index("MSOA")["net_income"]),
+    dtype="Int32",
+)
 logging.info(f"Check dataset shape: {df.shape}")
 
 ####################### ADD VOTING DATA ####################################
 logging.info(
     "\n\nAdd in voting data from the 2021 local elections, find local authorities with high pct of Green vote"
 )
-voting_data = pd.read_csv("data/CBP09228_detailed_results_England_elections.csv")
+voting_data = reads["voting"].result()
 logging.info("Find % of vote that is green, and compute which LAs exceed threshold")
-voting_data["pct_green"] = voting_data["Green"] / voting_data["Total"]
-voting_data["green_council"] = voting_data["pct_green"] >= POLITICALLY_GREEN_THRESHOLD
-logging.info("Tidy up columns and merge with main dataset")
-voting_data = voting_data[["ONS code", "green_council"]].copy()
+pct_green = voting_data["Green"].to_numpy() / voting_data["Total"].to_numpy()
+voting_data["green_council"] = pct_green >= POLITICALLY_GREEN_THRESHOLD
+logging.info("Tidy up columns and look up green councils for each LA in main dataset")
+voting_data = voting_data[["ONS code", "green_council"]]
 voting_data.columns = ["LA", "politically_green"]
-df = df.merge(voting_data, on="LA", how="left")
+df["politically_green"] = pd.array(
+    lookup_by_category(df["LA"], voting_data.set_index("LA")["politically_green"]),
+    dtype="boolean",
+)
 
 ####################### ECONOMIC ACTIVITY DATA ##############################
 logging.info("\n\nAdding dataset on economic activity from ONS, by local authority")
 logging.info("Read in csv and tidy up columns")
-economic_activity = pd.read_csv("data/economic_activity.csv")
-economic_activity = economic_activity[
-    [
-        "Area code",
-        "Economically active: \nIn employment \n(including full-time students), \n2021\n(percent)",
-    ]
-]
+economic_activity = reads["economic_activity"].result()
 economic_activity.columns = ["LA", "pct_economically_active"]
-logging.info("Merge with main dataset")
-df = df.merge(economic_activity, on="LA", how="left")
+logging.info("Look up economic activity for each LA in main dataset")
+df["pct_economically_active"] = lookup_by_category(
+    df["LA"], economic_activity.set_index("LA")["pct_economically_active"]
+)
 logging.info(f"Check dataset shape: {df.shape}")
 
 ####################### HOME OCCUPANCY DATA ##################################
@@ -214,172 +408,124 @@ logging.info(
     "\n\nAdding dataset on home size and household occupancy from ONS for 2021. Features by LSOA"
 )
 logging.info("Read in csv and tidy up columns")
-households = pd.read_csv("data/RM202-Household-Size-By-Number-Of-Rooms-2021-lsoa-ONS.csv")
+households = reads["households"].result()
 households.rename(columns={"Lower layer Super Output Areas Code": "LSOA"}, inplace=True)
 
 logging.info(
-    "Compute the percentage of home occupancy and multiply by no. of observations of that occupancy"
-)
-households["pct_home_occupancy"] = (
-    households["Household size (5 categories) Code"]
-    / households["Number of rooms (Valuation Office Agency) (6 categories) Code"]
-)
-households["pct_home_occupancy_x_obs"] = (
-    households["pct_home_occupancy"] * households["Observation"]
-)
-
-logging.info(
-    "Compute the size of each home multiplied by the no. of observations of that size."
-)
-households["home_size_x_obs"] = (
-    households["Number of rooms (Valuation Office Agency) (6 categories) Code"]
-    * households["Observation"]
+    "Compute the percentage of home occupancy and size of each home, multiplied by the no. of observations of that occupancy / size"
 )
+rooms = households[
+    "Number of rooms (Valuation Office Agency) (6 categories) Code"
+].to_numpy()
+household_size = households["Household size (5 categories) Code"].to_numpy()
+observations = households["Observation"].to_numpy()
+pct_home_occupancy_x_obs = household_size / rooms * observations
+home_size_x_obs = rooms * observations
 
 logging.info(
     "Sum each of these computed fields for each LSOA and divide by the total number of homes in that LSOA"
 )
-totals = (
-    households.groupby("LSOA")[
-        ["pct_home_occupancy_x_obs", "home_size_x_obs", "Observation"]
-    ]
-    .sum()
-    .reset_index()
+# factorize once, then each per-LSOA sum is a single np.bincount pass
+codes, lsoas = pd.factorize(households["LSOA"], sort=False)
+homes = np.bincount(codes, weights=observations)
+totals = pd.DataFrame(
+    {
+        "LSOA": lsoas,
+        "home_size": np.bincount(codes, weights=home_size_x_obs) / homes,
+        "pct_home_occupancy": np.bincount(codes, weights=pct_home_occupancy_x_obs)
+        / homes,
+    }
 )
-totals["home_size"] = totals["home_size_x_obs"] / totals["Observation"]
-totals["pct_home_occupancy"] = totals["pct_home_occupancy_x_obs"] / totals["Observation"]
 logging.info(
     f"Mean home size of {totals.home_size.mean()}. Mean occupancy % of {totals.pct_home_occupancy.mean()}"
 )
 
-logging.info("Tidy up columns and merge with main dataset")
-totals = totals[["LSOA", "home_size", "pct_home_occupancy"]]
-df = df.merge(totals, on="LSOA", how="left")
-logging.info(f"Check dataset shape: {df.shape}")
+logging.info("Tidy up columns, ready to join with main dataset")
+totals["LSOA"] = totals["LSOA"].astype(df["LSOA"].dtype)
+lsoa_features = [totals.set_index("LSOA")]
 
 ####################### BUILDING TYPE DATA ##################################
 logging.info(
     "\n\nAdding data on building type from gov.uk council tax dataset on stock of properties for 2021"
 )
-building_type = pd.read_csv("data/CTSOP_3_1_2021.csv")
+building_type = reads["building_type"].result()
 logging.info(
-    "Filtering down to LSOA only and all council tax bands, tidying up columns and replacing dodgy characters"
+    "Filtering down to LSOA only and all council tax bands, and filling in the counts recorded as '-' with zero"
 )
 building_type = building_type[
     (building_type.geography == "LSOA") & (building_type.band == "All")
-]
-building_type = building_type[
-    [
-        "ecode",
-        "bungalow_total",
-        "flat_mais_total",
-        "house_terraced_total",
-        "house_semi_total",
-        "house_detached_total",
-        "all_properties",
-    ]
-]
-building_type = building_type.replace("-", "0")
+].drop(columns=["geography", "band"])
+type_columns = building_type.columns.drop("ecode")
+building_type[type_columns] = building_type[type_columns].fillna(0).astype(np.int32)
 
 logging.info(
-    "Define the number of 'exposed surfaces' per building type as a dictionary - assumption that flats are more energy-efficient for this reason"
+    "Convert the building type count columns to a matrix, and the exposed surfaces to a matching vector"
+)
+building_types = list(exposed_surfaces_per_type)
+type_counts = building_type[building_types].to_numpy(dtype=np.float64)
+surfaces = np.array(
+    [exposed_surfaces_per_type[t] for t in building_types], dtype=np.float64
 )
-exposed_surfaces_per_type = {
-    "bungalow_total": 5,
-    "flat_mais_total": 2,
-    "house_terraced_total": 3,
-    "house_semi_total": 4,
-    "house_detached_total": 5,
-}
-
-logging.info("Convert the building type count columns to integers")
-building_type[list(exposed_surfaces_per_type.keys())] = building_type[
-    exposed_surfaces_per_type.keys()
-].astype(int)
 
 logging.info(
-    "Multiply building type count columns by the number of exposed surfaces to get totals"
-)
-total_exposed_surfaces = (
-    building_type[list(exposed_surfaces_per_type.keys())]
-    .mul(exposed_surfaces_per_type)
-    .sum(axis=1)
+    "Multiply building type counts by the number of exposed surfaces to get totals, as one matrix-vector product"
 )
+total_exposed_surfaces = type_counts @ surfaces
 logging.info("Compute the average number of exposed surfaces for properties in that LSOA")
-building_type["home_exposed_surfaces"] = [
-    x / int(y) for x, y in zip(total_exposed_surfaces, building_type["all_properties"])
-]
+building_type["home_exposed_surfaces"] = (
+    total_exposed_surfaces / building_type["all_properties"].to_numpy()
+)
 
-logging.info("Tidy up columns and merge with main dataset")
+logging.info("Tidy up columns, ready to join with main dataset")
 building_type = building_type[["ecode", "home_exposed_surfaces"]]
 building_type.columns = ["LSOA", "home_exposed_surfaces"]
-df = df.merge(building_type, on="LSOA", how="left")
-logging.info(f"Check dataset shape: {df.shape}")
+building_type["LSOA"] = building_type["LSOA"].astype(df["LSOA"].dtype)
+lsoa_features.append(building_type.set_index("LSOA"))
 
 ####################### BUILDING AGE DATA ###################################
 logging.info(
     "\n\nAdding in building age data from gov.uk council tax dataset on stock of properties for 2021"
 )
-building_age = pd.read_csv("data/CTSOP_4_1_2021.csv")
+building_age = reads["building_age"].result()
 logging.info(
-    "Filtering down to LSOA only and all council tax bands, tidying up columns and replacing weird characters"
+    "Filtering down to LSOA only and all council tax bands, and filling in the counts recorded as '-' with zero"
 )
 building_age = building_age[
     (building_age.geography == "LSOA") & (building_age.band == "All")
-]
-building_age = building_age.replace("-", "0")
+].drop(columns=["geography", "band"])
+building_age[build_periods] = building_age[build_periods].fillna(0).astype(np.int32)
 
 logging.info(
-    "Building age given in bands - estimate a rough mid-point for bands where applicable, as a dictionary."
+    "Convert the build period count columns to a matrix, and the build years to a matching vector"
 )
-build_dates = {
-    "bp_pre_1900": 1900,
-    "bp_1900_1918": 1910,
-    "bp_1919_1929": 1925,
-    "bp_1930_1939": 1935,
-    "bp_1945_1954": 1950,
-    "bp_1955_1964": 1960,
-    "bp_1965_1972": 1969,
-    "bp_1973_1982": 1978,
-    "bp_1983_1992": 1988,
-    "bp_1993_1999": 1996,
-    "bp_2000_2008": 2004,
-    "bp_2009": 2009,
-    "bp_2010": 2010,
-    "bp_2011": 2011,
-    "bp_2012": 2012,
-    "bp_2013": 2013,
-    "bp_2014": 2014,
-    "bp_2015": 2015,
-    "bp_2016": 2016,
-    "bp_2017": 2017,
-    "bp_2018": 2018,
-    "bp_2019": 2019,
-    "bp_2020": 2020,
-    "bp_2021": 2021,
-    "bp_2022_2023": 2021,
-    "bp_unkw": 1900,  # assume if unknown then likely very old
-}
-
-logging.info("Convert the building year count columns to integers")
-building_age[list(build_dates.keys())] = building_age[build_dates.keys()].astype(int)
+period_counts = building_age[build_periods].to_numpy(dtype=np.float64)
+build_years = np.array([build_dates[p] for p in build_periods], dtype=np.float64)
 
 logging.info(
-    "Multiply build period count columns by the assumed build year to get totals"
+    "Multiply build period counts by the assumed build year and sum the counts, in a single pass over the matrix"
 )
-build_year = building_age[list(build_dates.keys())].mul(build_dates).sum(axis=1)
+# the second column of weights is all ones, so it sums the number of properties
+build_year, totals = (
+    period_counts @ np.column_stack([build_years, np.ones_like(build_years)])
+).T
 logging.info("Compute the average age of buildings in each LSOA")
-totals = building_age[list(build_dates.keys())].sum(axis=1)
-building_age["home_age"] = [2021 - (x / y) for x, y in zip(build_year, totals)]
+building_age["home_age"] = 2021 - build_year / totals
 
-logging.info("Tidy up columns and merge with main dataset")
+logging.info("Tidy up columns, ready to join with main dataset")
 building_age = building_age[["ecode", "home_age"]]
 building_age.columns = ["LSOA", "home_age"]
-df = df.merge(building_age, on="LSOA", how="left")
+building_age["LSOA"] = building_age["LSOA"].astype(df["LSOA"].dtype)
+lsoa_features.append(building_age.set_index("LSOA"))
+
+####################### JOIN LSOA FEATURES ##################################
+logging.info(
+    f"\n\nJoining the {len(lsoa_features)} LSOA feature datasets with the main dataset in one pass"
+)
+df = df.set_index("LSOA").join(lsoa_features).reset_index()
 logging.info(f"Check dataset shape: {df.shape}")
 
-####################### WRITE CLEAN RESULTS TO CSV #############################
-logging.info("\n\nClean up columns and write to local csv file")
+####################### WRITE CLEAN RESULTS TO CSV / PARQUET ###################
+logging.info("\n\nClean up columns and write to local csv and parquet files")
 final_columns = [
     "LA",
     "MSOA",
@@ -395,6 +541,11 @@ final_columns = [
     "home_age",
     "energy_consumption_per_person",
 ]
-df = df[final_columns]
+df = df[final_columns].copy()  # one consolidated copy, rather than a view
+logging.info("Downcasting float features to single precision, to halve the file size")
+float_columns = df.select_dtypes(include="float64").columns
+df[float_columns] = df[float_columns].astype(np.float32)
 df.to_csv("compiled_data.csv", index=False)
+# parquet keeps the column dtypes, so analyse.py doesn't need to re-parse them
+df.to_parquet("compiled_data.parquet", engine="pyarrow", compression="snappy")
 logging.info("DATA COMPILATION COMPLETE")